@@ -1,25 +1,129 @@
-from itertools import chain
+import ctypes
+import ctypes.util
+from concurrent.futures import ThreadPoolExecutor
+import errno
+from functools import lru_cache
+from itertools import chain, islice
+import json
+import logging
 import os
 from pathlib import Path
+import queue
+import re
+import select
+import shutil
+import signal
+import sqlite3
+import stat
+import struct
 import subprocess
 import sys
+import threading
 import time
-from typing import Iterator, Tuple
+from typing import Callable, Generator, Iterable, Iterator, NamedTuple, Tuple
 
 from pathlib_extensions import prepare_input_dir, prepare_input_file, prepare_output_file
 from pymediainfo import MediaInfo
 
+try:
+    import pynvml
+    pynvml.nvmlInit()
+    NVML_AVAILABLE = True
+except Exception:  # the bindings are not installed, or the driver library cannot be loaded
+    NVML_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
 PROJECT_ROOT = Path(__file__).parents[1]
 HANDBRAKE_CONFIG = PROJECT_ROOT / "H264 NVENC CQ27.json"
+# resolved once, so that spawning HandBrake does not search PATH every time
+_HANDBRAKE_BIN = shutil.which("HandBrakeCLI") or "HandBrakeCLI"
+VIDEO_SUFFIXES = (".mkv", ".mp4", ".MKV", ".MP4")
+TRANSCODE_WORKERS = int(os.environ.get("HBD_CONCURRENCY", 2))
+HANDBRAKE_SLOTS = threading.Semaphore(int(os.environ.get("HBD_NVENC_SLOTS", 2)))  # concurrent NVENC sessions
+DURATION_TOLERANCE_MS = int(os.environ.get("HBD_DURATION_TOL_MS", 500))  # at 30 fps, 500ms is 15 frames
+MAX_STALL_ATTEMPTS = int(os.environ.get("HBD_MAX_STALLS", 3))  # per input, until the file changes
+
+_LIBC = ctypes.CDLL(None, use_errno=True) if sys.platform == "linux" else None
+
+# see statx(2)
+AT_FDCWD = -100
+AT_STATX_DONT_SYNC = 0x4000
+STATX_TYPE = 0x0001
+STATX_MODE = 0x0002
+STATX_MTIME = 0x0040
+STATX_SIZE = 0x0200
+STATX_BUFFER_SIZE = 256  # sizeof(struct statx)
+STATX_FIELDS = struct.Struct("=28xH10xQ")  # stx_mode at offset 28, stx_size at offset 40
+STATX_MTIME_FIELDS = struct.Struct("=qI")  # stx_mtime.tv_sec and stx_mtime.tv_nsec at offset 112
+
+# see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+# MP4 sample description entries and Matroska codec IDs for AVC and HEVC video
+VIDEO_CODEC_PATTERN = re.compile(rb"stsd.{12}(avc1|avc3|hvc1|hev1)|(V_MPEG4/ISO/AVC|V_MPEGH/ISO/HEVC)", re.DOTALL)
+SNIFF_CODECS = {b"avc1": "AVC", b"avc3": "AVC", b"hvc1": "HEVC", b"hev1": "HEVC", b"V_MPEG4/ISO/AVC": "AVC", b"V_MPEGH/ISO/HEVC": "HEVC"}
+
+# only the container headers are needed for the video format and duration, so MediaInfo need not scan the streams
+MEDIAINFO_PARSE_SPEED = 0.0
+
+# e.g. "Encoding: task 1 of 1, 12.34 % (45.67 fps, avg 50.00 fps, ETA 00h10m00s)"
+HANDBRAKE_PROGRESS_PATTERN = re.compile(r"Encoding: task \d+ of \d+, (\d+)\.\d+ %")
+
+# persists video codec probes across restarts, keyed by absolute path and invalidated by size and modification time
+STATE_DB_PATH = os.environ.get("HBD_STATE_DB", str(Path.home() / ".cache" / "handbrake-daemon" / "state.db"))
+_STATE_DB: sqlite3.Connection | None = None
+_STATE_DB_LOCK = threading.RLock()  # the connection is shared between threads
+
+# files to be deleted by `run_janitor`
+_JANITOR_QUEUE: queue.SimpleQueue[Path] = queue.SimpleQueue()
+
+
+class FileStat(NamedTuple):
+    """
+    Subset of file status used to decide whether a file has changed.
+    """
+    mode: int
+    size: int
+    mtime_ns: int
+
+
+class TranscodeStalled(Exception):
+    """
+    Raised when HandBrake stops reporting encoding progress.
+    """
 
 
 def is_gpu_healthy() -> bool:
     """
-    Checks if the GPU is healthy and available by running nvidia-smi.
-    
+    Checks if the GPU is healthy and available by querying the power state of every GPU through NVML, or its name if
+    the power state is not supported.
+
+    Falls back to running nvidia-smi if NVML is unavailable.
+
     Returns:
-        bool: True if nvidia-smi finished with exit code 0, False otherwise.
+        bool: True if at least one GPU is found and all GPUs respond (or nvidia-smi finished with exit code 0), False otherwise.
     """
+    if NVML_AVAILABLE:
+        try:
+            device_count = pynvml.nvmlDeviceGetCount()
+            for i in range(device_count):
+                handle = pynvml.nvmlDeviceGetHandleByIndex(i)
+                try:
+                    pynvml.nvmlDeviceGetPowerState(handle)
+                except pynvml.NVMLError_NotSupported:
+                    # some consumer and virtualised GPUs do not report their power state
+                    pynvml.nvmlDeviceGetName(handle)
+            return device_count > 0
+        except pynvml.NVMLError:
+            return False
     try:
         result = subprocess.run(["nvidia-smi"], check=False)
         return result.returncode == 0
@@ -27,6 +131,62 @@ def is_gpu_healthy() -> bool:
         return False
 
 
+def _is_video_file_name(name: str) -> bool:
+    """
+    Check if a file name has a supported video suffix, case-insensitively. Only mixed-case suffixes pay for `str.lower`.
+    """
+    return name.endswith(VIDEO_SUFFIXES) or name.lower().endswith(VIDEO_SUFFIXES)
+
+
+def _try_stat(file_path: Path | str) -> os.stat_result | None:
+    """
+    Get the status of a file with a single syscall, so that existence, type and size checks can share it.
+
+    Args:
+        file_path (Path | str): Path to the file.
+
+    Returns:
+        os.stat_result | None: Status of the file, or None if it does not exist.
+    """
+    try:
+        return os.stat(file_path)
+    except FileNotFoundError:
+        return None
+
+
+def _fast_stat(file_path: Path, synced: bool = False) -> FileStat:
+    """
+    Get the type, size and modification time of a file.
+
+    On Linux, this uses statx(2) with `AT_STATX_DONT_SYNC`, so that network filesystems may answer from their attribute
+    cache instead of revalidating with the server. Elsewhere, or if statx is unavailable, it falls back to `os.stat`.
+
+    Args:
+        file_path (Path): Path to the file.
+        synced (bool, optional): Whether to use `os.stat`, which network filesystems revalidate with the server.
+            Defaults to False.
+
+    Returns:
+        FileStat: Status of the file.
+
+    Raises:
+        OSError: If the file cannot be accessed.
+    """
+    if not synced and _LIBC is not None and hasattr(_LIBC, "statx"):
+        buffer = ctypes.create_string_buffer(STATX_BUFFER_SIZE)
+        mask = STATX_TYPE | STATX_MODE | STATX_SIZE | STATX_MTIME
+        if _LIBC.statx(AT_FDCWD, os.fsencode(file_path), AT_STATX_DONT_SYNC, mask, buffer) == 0:
+            mode, size = STATX_FIELDS.unpack_from(buffer)
+            mtime_seconds, mtime_nanoseconds = STATX_MTIME_FIELDS.unpack_from(buffer, 112)
+            return FileStat(mode, size, mtime_seconds * 1_000_000_000 + mtime_nanoseconds)
+        error_code = ctypes.get_errno()
+        # statx may be missing from old kernels, or blocked by old container seccomp profiles
+        if error_code not in (errno.ENOSYS, errno.EPERM):
+            raise OSError(error_code, os.strerror(error_code), str(file_path))
+    stat_result = os.stat(file_path)
+    return FileStat(stat_result.st_mode, stat_result.st_size, stat_result.st_mtime_ns)
+
+
 def wait_until_file_stable(file_path: Path, check_interval_seconds: float = 2, stability_duration_seconds: float = 5, timeout_seconds: float = 60) -> bool:
     """
     Block until a file is no longer being changed by monitoring size and modification time.
@@ -40,41 +200,216 @@ def wait_until_file_stable(file_path: Path, check_interval_seconds: float = 2, s
     Returns:
         bool: True if the file has stabilized, False if the file is inaccessible or empty.
     """
-    if not file_path.is_file():
+    try:
+        last_stat = _fast_stat(file_path)
+    except OSError:
+        return False
+    if not stat.S_ISREG(last_stat.mode):
         return False
     try:
-        print(f"Monitoring file: {file_path}")
+        logger.info("Monitoring file: %s", file_path)
         start_time = last_change_time = time.time()
-        last_stat = file_path.stat()
+        synced = False
         while True:
             time.sleep(check_interval_seconds)
             current_time = time.time()
-            current_stat = file_path.stat()
+            current_stat = _fast_stat(file_path, synced=synced)
             # case 1: file is empty
-            if current_stat.st_size == 0:
-                print(f"File is empty: {file_path}")
+            if current_stat.size == 0:
+                logger.info("File is empty: %s", file_path)
                 return False
             # case 2: file has changed
-            if current_stat.st_size != last_stat.st_size or current_stat.st_mtime != last_stat.st_mtime:
-                print(f"File has changed: {file_path}")
+            if current_stat != last_stat:
+                logger.info("File has changed: %s", file_path)
                 last_change_time = current_time
                 last_stat = current_stat
                 continue
-            # case 3: file has stabilized
+            # case 3: file has stabilized. Samples may come from a stale attribute cache of a network filesystem, which
+            # looks frozen while another host is still writing, so the final sample is confirmed with a synced stat.
+            # If they disagree, the cache cannot be trusted, and the remaining samples are synced as well.
             if current_time - last_change_time >= stability_duration_seconds:
-                print(f"File has stabilized: {file_path}")
+                if (synced_stat := _fast_stat(file_path, synced=True)) != last_stat:
+                    logger.info("File has changed: %s", file_path)
+                    last_change_time = current_time
+                    last_stat = synced_stat
+                    synced = True
+                    continue
+                logger.info("File has stabilized: %s", file_path)
                 return True
             # case 4: timeout
             if current_time - start_time >= timeout_seconds:
-                print(f"Timeout waiting for file to stabilize: {file_path}")
+                logger.warning("Timeout waiting for file to stabilize: %s", file_path)
                 return False
             # case 5: file did not change, but we're waiting for the stability duration to finish
-            print(f"Waiting for the stability duration to finish: {file_path}")
+            logger.info("Waiting for the stability duration to finish: %s", file_path)
     except (OSError, FileNotFoundError) as e:
-        print(f"Could not wait for file {file_path} to stabilize due to {type(e).__name__}: {e}")
+        logger.warning("Could not wait for file %s to stabilize due to %s: %s", file_path, type(e).__name__, e)
         return False
 
 
+class InotifyWatcher:
+    """
+    Watch directory trees for video files that have been closed after writing or moved into place, using Linux inotify.
+
+    Events are read by a background thread. Subdirectories created or moved in after the watcher has started are
+    watched as well. If the kernel event queue overflows, `overflowed` is set to signal that events have been lost.
+    """
+
+    def __init__(self, *dir_paths: Path) -> None:
+        """
+        Args:
+            *dir_paths (Path): One or more directory paths to watch recursively.
+
+        Raises:
+            OSError: If inotify is unavailable, or a watch cannot be added.
+        """
+        if _LIBC is None:
+            raise OSError(f"inotify is not available on {sys.platform}")
+        self._libc = _LIBC
+        self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            error_code = ctypes.get_errno()
+            raise OSError(error_code, os.strerror(error_code))
+        self._watches: dict[int, Path] = {}
+        self._closed_file_paths: queue.Queue[Path] = queue.Queue()
+        self._stopped = threading.Event()
+        self.overflowed = threading.Event()
+        try:
+            for dir_path in dir_paths:
+                self._add_watches(dir_path)
+        except OSError:
+            os.close(self._fd)
+            raise
+        self._thread = threading.Thread(target=self._read_events, name="inotify-watcher", daemon=True)
+        self._thread.start()
+
+    def _add_watches(self, dir_path: Path) -> None:
+        for current_dir, _, _ in os.walk(dir_path):
+            mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(current_dir), mask)
+            if wd < 0:
+                error_code = ctypes.get_errno()
+                raise OSError(error_code, os.strerror(error_code), current_dir)
+            self._watches[wd] = Path(current_dir)
+
+    def _read_events(self) -> None:
+        while not self._stopped.is_set():
+            if not select.select([self._fd], [], [], 1)[0]:
+                continue
+            try:
+                buffer = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, name_length = INOTIFY_EVENT.unpack_from(buffer, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(buffer[offset:offset + name_length].rstrip(b"\0"))
+                offset += name_length
+                self._handle_event(wd, mask, name)
+
+    def _handle_event(self, wd: int, mask: int, name: str) -> None:
+        if mask & IN_Q_OVERFLOW:
+            logger.warning("Inotify event queue overflowed")
+            self.overflowed.set()
+            return
+        if mask & IN_IGNORED:
+            self._watches.pop(wd, None)
+            return
+        if (dir_path := self._watches.get(wd)) is None:
+            return
+        path = dir_path / name
+        if mask & IN_ISDIR:
+            try:
+                self._add_watches(path)
+            except OSError as e:
+                logger.warning("Could not watch directory %s due to %s: %s", path, type(e).__name__, e)
+                return
+            # files in a directory that was moved into place, or written to a new directory before it was watched, do
+            # not raise events of their own. Files that are still being written are held back by the stability check
+            # in `yield_transcode_tasks_for_files`.
+            for file_path in _walk_videos(path):
+                self._closed_file_paths.put(file_path)
+        # files are only reported once closed or moved into place, not when they are created
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and _is_video_file_name(name):
+            self._closed_file_paths.put(path)
+
+    def get_closed_file_paths(self, timeout_seconds: float) -> list[Path]:
+        """
+        Block until at least one video file has been closed or moved into place, then return all such files reported so far.
+
+        Args:
+            timeout_seconds (float): Maximum time to wait for the first file.
+
+        Returns:
+            list[Path]: Deduplicated paths of the reported files, or an empty list on timeout.
+        """
+        try:
+            file_paths = [self._closed_file_paths.get(timeout=timeout_seconds)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                file_paths.append(self._closed_file_paths.get_nowait())
+            except queue.Empty:
+                return list(dict.fromkeys(file_paths))
+
+    def close(self) -> None:
+        """
+        Stop the background thread and release the inotify file descriptor.
+        """
+        self._stopped.set()
+        self._thread.join()
+        os.close(self._fd)
+
+
+def _sniff_video_codec(file_path: Path, max_bytes: int = 1 << 20) -> str | None:
+    """
+    Guess the codec of the first video track from the container headers at the start of a file, without MediaInfo.
+
+    This only works if the headers are near the start of the file, e.g. in MKV files and MP4 files with the `moov` box
+    placed before the media data.
+
+    Args:
+        file_path (Path): Path to the video file.
+        max_bytes (int, optional): Maximum number of bytes to read (default 1 MiB).
+
+    Returns:
+        str | None: "AVC" or "HEVC", or None if inconclusive.
+    """
+    try:
+        with open(file_path, "rb") as f:
+            buffer = f.read(max_bytes)
+    except OSError:
+        return None
+    if match := VIDEO_CODEC_PATTERN.search(buffer):
+        return SNIFF_CODECS[match.group(1) or match.group(2)]
+    return None
+
+
+def get_video_codec(file_path: Path) -> str | None:
+    """
+    Get the format of the first video track of a file, e.g. "AVC" or "HEVC".
+
+    A cheap sniff of the container headers is tried first, and MediaInfo is only used if it is inconclusive.
+
+    Args:
+        file_path (Path): Path to the video file.
+
+    Returns:
+        str | None: Format of the first video track, or None if no video track is found.
+    """
+    if (codec := _sniff_video_codec(file_path)) is not None:
+        return codec
+    try:
+        if (track_info := _probe_video_track(prepare_input_file(file_path))) is not None:
+            return track_info.format
+    except Exception as e:
+        logger.warning("Could not check encoding of %s due to %s: %s", file_path, type(e).__name__, e)
+    return None
+
+
 def is_h264_encoded(file_path: Path) -> bool | None:
     """
     Check if a video file is encoded in H264/AVC format.
@@ -85,70 +420,493 @@ def is_h264_encoded(file_path: Path) -> bool | None:
     Returns:
         bool | None: True if the video is H264/AVC encoded, False otherwise, or None if no video track is found.
     """
+    if (codec := get_video_codec(file_path)) is None:
+        return None
+    return codec == "AVC"
+
+
+def _open_state_db(db_path: str) -> sqlite3.Connection:
+    """
+    Open the state database, creating it if needed. Falls back to an in-memory database if it cannot be opened.
+
+    Args:
+        db_path (str): Path to the SQLite database file, or ":memory:".
+
+    Returns:
+        sqlite3.Connection: Connection in autocommit mode, usable from any thread while holding `_STATE_DB_LOCK`.
+    """
+    try:
+        if db_path != ":memory:":
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS probe (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, codec TEXT, probed_at INTEGER)")
+        connection.execute("CREATE TABLE IF NOT EXISTS stall (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, attempts INTEGER)")
+        return connection
+    except (OSError, sqlite3.Error) as e:
+        logger.warning("Could not open state database %s due to %s: %s", db_path, type(e).__name__, e)
+        return _open_state_db(":memory:")
+
+
+def _get_state_db() -> sqlite3.Connection:
+    """
+    Get the state database connection, opening it on first use.
+    """
+    global _STATE_DB
+    with _STATE_DB_LOCK:
+        if _STATE_DB is None:
+            _STATE_DB = _open_state_db(STATE_DB_PATH)
+        return _STATE_DB
+
+
+def _load_cached_codec(file_path: Path, stat_result: os.stat_result) -> str | None:
+    """
+    Look up the video codec of a file in the state database.
+
+    Returns:
+        str | None: Cached codec, or None if the file has not been probed since it was last changed.
+    """
+    with _STATE_DB_LOCK:
+        row = _get_state_db().execute(
+            "SELECT codec FROM probe WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (os.path.abspath(file_path), stat_result.st_size, stat_result.st_mtime_ns),
+        ).fetchone()
+    return None if row is None else row[0]
+
+
+def _store_cached_codec(file_path: Path, stat_result: os.stat_result, codec: str) -> None:
+    """
+    Store the video codec of a file in the state database, replacing any previous entry for the same path.
+    """
+    with _STATE_DB_LOCK:
+        _get_state_db().execute(
+            "INSERT OR REPLACE INTO probe (path, size, mtime_ns, codec, probed_at) VALUES (?, ?, ?, ?, ?)",
+            (os.path.abspath(file_path), stat_result.st_size, stat_result.st_mtime_ns, codec, int(time.time())),
+        )
+
+
+def is_h264_encoded_cached(file_path: Path, stat_result: os.stat_result | None = None) -> bool | None:
+    """
+    Same as `is_h264_encoded`, but results are cached in the state database until the size or modification time of
+    the file changes, so that they survive restarts.
+
+    Args:
+        file_path (Path): Path to the video file.
+        stat_result (os.stat_result | None, optional): Status of the file, if the caller already has it. Defaults to None.
+
+    Returns:
+        bool | None: True if the video is H264/AVC encoded, False otherwise, or None if no video track is found.
+    """
+    if stat_result is None:
+        try:
+            stat_result = file_path.stat()
+        except OSError:
+            return is_h264_encoded(file_path)
+    if (codec := _load_cached_codec(file_path, stat_result)) is None:
+        if (codec := get_video_codec(file_path)) is None:  # do not cache probe failures, which may be transient
+            return None
+        _store_cached_codec(file_path, stat_result, codec)
+    return codec == "AVC"
+
+
+def prune_h264_cache() -> None:
+    """
+    Remove cached `is_h264_encoded` results and stall counts for files that no longer exist.
+    """
+    with _STATE_DB_LOCK:
+        connection = _get_state_db()
+        for table in ("probe", "stall"):
+            missing = [(path,) for path, in connection.execute(f"SELECT path FROM {table}") if not os.path.exists(path)]
+            connection.executemany(f"DELETE FROM {table} WHERE path = ?", missing)
+
+
+def load_stall_attempts(file_path: Path) -> int:
+    """
+    Get the number of times HandBrake has stalled on a file since it was last changed.
+
+    Args:
+        file_path (Path): Path to the input video file.
+
+    Returns:
+        int: Number of stalled attempts, or 0 if the file cannot be accessed.
+    """
+    if (stat_result := _try_stat(file_path)) is None:
+        return 0
+    with _STATE_DB_LOCK:
+        row = _get_state_db().execute(
+            "SELECT attempts FROM stall WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (os.path.abspath(file_path), stat_result.st_size, stat_result.st_mtime_ns),
+        ).fetchone()
+    return 0 if row is None else row[0]
+
+
+def record_stall(file_path: Path) -> int:
+    """
+    Count a stalled attempt on a file in the state database. Counts of earlier versions of the file are discarded.
+
+    Args:
+        file_path (Path): Path to the input video file.
+
+    Returns:
+        int: Number of stalled attempts since the file was last changed, including this one.
+    """
+    if (stat_result := _try_stat(file_path)) is None:
+        return 0
+    with _STATE_DB_LOCK:
+        attempts = load_stall_attempts(file_path) + 1
+        _get_state_db().execute(
+            "INSERT OR REPLACE INTO stall (path, size, mtime_ns, attempts) VALUES (?, ?, ?, ?)",
+            (os.path.abspath(file_path), stat_result.st_size, stat_result.st_mtime_ns, attempts),
+        )
+    return attempts
+
+
+class VideoTrackInfo(NamedTuple):
+    """
+    Format and duration of the first video track of a file.
+    """
+    format: str | None
+    duration_ms: int | None
+
+
+def _parse_milliseconds(value: str | int | float) -> int:
+    """
+    Parse a MediaInfo duration in milliseconds, e.g. '3614866.000000', truncating any fractional part.
+    """
+    return int(str(value).split(".", 1)[0])
+
+
+def _parse_seconds_as_milliseconds(value: str) -> int:
+    """
+    Parse a MediaInfo duration in seconds, e.g. '3614.866', as integer milliseconds without a float round trip.
+    """
+    seconds, _, fraction = value.partition(".")
+    return int(seconds or 0) * 1000 + int((fraction + "000")[:3])
+
+
+def _load_mediainfo_library() -> ctypes.CDLL | None:
+    """
+    Load libmediainfo and declare the signatures of the functions used by `_MediaInfoHandle`.
+
+    Returns:
+        ctypes.CDLL | None: The library, or None if it cannot be loaded.
+    """
     try:
-        for track in MediaInfo.parse(prepare_input_file(file_path)).tracks:
+        library = ctypes.CDLL(ctypes.util.find_library("mediainfo") or "libmediainfo.so.0")
+    except OSError:
+        return None
+    library.MediaInfo_New.argtypes = []
+    library.MediaInfo_New.restype = ctypes.c_void_p
+    library.MediaInfo_Option.argtypes = [ctypes.c_void_p, ctypes.c_wchar_p, ctypes.c_wchar_p]
+    library.MediaInfo_Option.restype = ctypes.c_wchar_p
+    library.MediaInfo_Open.argtypes = [ctypes.c_void_p, ctypes.c_wchar_p]
+    library.MediaInfo_Open.restype = ctypes.c_size_t
+    library.MediaInfo_Inform.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    library.MediaInfo_Inform.restype = ctypes.c_wchar_p
+    library.MediaInfo_Close.argtypes = [ctypes.c_void_p]
+    library.MediaInfo_Close.restype = None
+    library.MediaInfo_Delete.argtypes = [ctypes.c_void_p]
+    library.MediaInfo_Delete.restype = None
+    return library
+
+
+class _MediaInfoHandle:
+    """
+    A reusable libmediainfo handle that reports only the format and duration of video tracks, as a compact text report
+    instead of the full XML report parsed by pymediainfo. Handles must not be shared between threads, and are released
+    when they are garbage collected, e.g. when the thread owning a per-thread handle exits.
+    """
+
+    def __init__(self, library: ctypes.CDLL) -> None:
+        self._library = library
+        self._handle = library.MediaInfo_New()
+        library.MediaInfo_Option(self._handle, "Inform", "Video;%Format%|%Duration%\\n")
+        library.MediaInfo_Option(self._handle, "ParseSpeed", str(MEDIAINFO_PARSE_SPEED))
+
+    def __del__(self) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Release the native handle. Calling it more than once has no effect.
+        """
+        if (handle := getattr(self, "_handle", None)) is not None:
+            self._handle = None
+            self._library.MediaInfo_Delete(handle)
+
+    def probe(self, file_path: Path) -> VideoTrackInfo | None:
+        """
+        Probe the first video track of a file.
+
+        Args:
+            file_path (Path): Path to the video file.
+
+        Returns:
+            VideoTrackInfo | None: Format and duration of the first video track, or None if no video track is found.
+
+        Raises:
+            OSError: If the file cannot be opened by MediaInfo.
+        """
+        if not self._library.MediaInfo_Open(self._handle, os.fspath(file_path)):
+            raise OSError(f"MediaInfo could not open {file_path}")
+        try:
+            report = self._library.MediaInfo_Inform(self._handle, 0) or ""
+        finally:
+            self._library.MediaInfo_Close(self._handle)
+        if not (line := report.strip().split("\n", 1)[0]):
+            return None
+        video_format, _, duration = line.partition("|")
+        return VideoTrackInfo(video_format or None, _parse_milliseconds(duration) if duration else None)
+
+
+_MEDIAINFO_LIBRARY = _load_mediainfo_library()
+_MEDIAINFO_HANDLES = threading.local()
+
+
+@lru_cache(maxsize=1024)
+def _parse_tracks(path_str: str, mtime_ns: int, size: int) -> VideoTrackInfo | None:
+    """
+    Probe the first video track of a file with a per-thread `_MediaInfoHandle`, or with pymediainfo if libmediainfo
+    cannot be loaded directly.
+
+    Results are cached by path, modification time and size, so that an unchanged file is only parsed once.
+
+    Args:
+        path_str (str): Path to the video file.
+        mtime_ns (int): Modification time of the file in nanoseconds.
+        size (int): Size of the file in bytes.
+
+    Returns:
+        VideoTrackInfo | None: Format and duration of the first video track, or None if no video track is found.
+
+    Raises:
+        Exception: If the file cannot be parsed.
+    """
+    if _MEDIAINFO_LIBRARY is None:
+        for track in MediaInfo.parse(path_str, parse_speed=MEDIAINFO_PARSE_SPEED).tracks:
             if track.track_type == "Video":
-                return track.format == "AVC"
-    except Exception as e:
-        print(f"Could not check encoding of {file_path} due to {type(e).__name__}: {e}")
-    return
+                # track.duration might look like '3614866.000000'
+                return VideoTrackInfo(track.format, None if track.duration is None else _parse_milliseconds(track.duration))
+        return None
+    if (handle := getattr(_MEDIAINFO_HANDLES, "handle", None)) is None:
+        handle = _MEDIAINFO_HANDLES.handle = _MediaInfoHandle(_MEDIAINFO_LIBRARY)
+    return handle.probe(Path(path_str))
+
+
+def _probe_video_track(file_path: Path) -> VideoTrackInfo | None:
+    """
+    Probe the first video track of a file through `_parse_tracks`.
+
+    Args:
+        file_path (Path): Path to the video file.
+
+    Returns:
+        VideoTrackInfo | None: Format and duration of the first video track, or None if no video track is found.
+
+    Raises:
+        Exception: If the file cannot be accessed or parsed.
+    """
+    file_stat = _fast_stat(file_path)
+    return _parse_tracks(str(file_path), file_stat.mtime_ns, file_stat.size)
 
 
-def get_output_file_path_for_mp4(input_file_path: Path, max_retries: int = 5) -> Path | None:
+class MediaInfoBatcher:
+    """
+    Probe the first video track of many files with a reused in-process libmediainfo handle, or otherwise with one
+    `mediainfo --Output=JSON` invocation per batch, instead of one pymediainfo parse per file.
+    """
+
+    def __init__(self, batch_size: int = 64, executable: str | None = shutil.which("mediainfo")) -> None:
+        """
+        Args:
+            batch_size (int, optional): Maximum number of files per `mediainfo` invocation. Defaults to 64.
+            executable (str | None, optional): Path to the `mediainfo` CLI. Defaults to the one on PATH.
+        """
+        self.batch_size = batch_size
+        self.executable = executable
+
+    def _probe_batch(self, executable: str, file_paths: list[Path]) -> dict[Path, VideoTrackInfo | None]:
+        refs = {os.path.abspath(file_path): file_path for file_path in file_paths}
+        try:
+            result = subprocess.run([executable, f"--ParseSpeed={MEDIAINFO_PARSE_SPEED}", "--Output=JSON", *refs], capture_output=True, check=True, timeout=600)
+            reports = json.loads(result.stdout)
+        except Exception as e:
+            logger.warning("Could not probe %s files with mediainfo due to %s: %s", len(file_paths), type(e).__name__, e)
+            return {}
+        probed: dict[Path, VideoTrackInfo | None] = {}
+        for report in reports if isinstance(reports, list) else [reports]:  # a single file is reported as an object
+            media = report.get("media") or {}
+            if (file_path := refs.get(media.get("@ref", ""))) is None:
+                continue
+            probed[file_path] = None
+            for track in media.get("track", []):
+                if track.get("@type") == "Video":
+                    duration = track.get("Duration")  # in seconds, e.g. "3614.866"
+                    probed[file_path] = VideoTrackInfo(track.get("Format"), None if duration is None else _parse_seconds_as_milliseconds(duration))
+                    break
+        return probed
+
+    def probe(self, file_paths: Iterable[Path]) -> dict[Path, VideoTrackInfo | None]:
+        """
+        Probe the first video track of each file.
+
+        Args:
+            file_paths (Iterable[Path]): Paths to video files.
+
+        Returns:
+            dict[Path, VideoTrackInfo | None]: Video track info by file path, or None if a file has no video track.
+                Files that could not be probed are omitted, and so are all files if neither libmediainfo nor the
+                `mediainfo` CLI is available.
+        """
+        probed: dict[Path, VideoTrackInfo | None] = {}
+        if _MEDIAINFO_LIBRARY is not None:
+            # an in-process handle has no per-file setup cost left to amortize, so spawning the CLI would only add a fork
+            for file_path in file_paths:
+                try:
+                    probed[file_path] = _probe_video_track(file_path)
+                except Exception as e:
+                    logger.warning("Could not probe %s due to %s: %s", file_path, type(e).__name__, e)
+            return probed
+        if (executable := self.executable) is None:
+            return probed
+        file_paths = iter(file_paths)
+        while batch := list(islice(file_paths, self.batch_size)):
+            probed.update(self._probe_batch(executable, batch))
+        return probed
+
+
+MEDIAINFO_BATCHER = MediaInfoBatcher()
+
+
+def prefetch_h264_cache(file_paths: Iterable[Path]) -> None:
+    """
+    Populate the `is_h264_encoded_cached` cache for files without a valid entry, using batched MediaInfo probes.
+
+    Args:
+        file_paths (Iterable[Path]): Paths to video files.
+    """
+    stat_results = {}
+    for file_path in file_paths:
+        try:
+            stat_result = file_path.stat()
+        except OSError:
+            continue
+        if _load_cached_codec(file_path, stat_result) is not None:
+            continue
+        if (codec := _sniff_video_codec(file_path)) is not None:
+            _store_cached_codec(file_path, stat_result, codec)
+        else:
+            stat_results[file_path] = stat_result
+    for file_path, track_info in MEDIAINFO_BATCHER.probe(stat_results).items():
+        if track_info is not None and track_info.format is not None:
+            _store_cached_codec(file_path, stat_results[file_path], track_info.format)
+
+
+def _derive_mp4_output(path_str: str, counter: int) -> str:
+    """
+    Derive the path of an MP4 output candidate, e.g. "dir/video.mp4" -> "dir/video.1.mp4". Same as
+    `Path.with_suffix(f".{counter}.mp4")`, but on raw strings, as candidates are derived repeatedly while probing.
+
+    Args:
+        path_str (str): Path to the input file.
+        counter (int): Counter of the candidate.
+
+    Returns:
+        str: Path to the candidate.
+    """
+    return f"{os.path.splitext(path_str)[0]}.{counter}.mp4"
+
+
+def get_output_file_path_for_mp4(input_file_path: Path, max_retries: int = 5, existing: set[str] | None = None) -> Path | None:
     """
     Generate HandBrake output file path for MP4 files.
 
+    Outputs are named `<stem>.<counter>.mp4` with increasing counters, so the existing candidates are expected to form a
+    contiguous run starting at 1. The first free counter is found by exponential probing followed by bisection, and
+    only the last existing candidate is checked for being an H264-encoded video file.
+
     Args:
         input_file_path (Path): Path to the input MP4 file.
         max_retries (int, optional): Maximum number of retries to find a unique filename. Defaults to 5.
+        existing (set[str] | None, optional): Names of all entries in the directory of the input file. If given, it
+            replaces existence checks on the filesystem. Defaults to None.
 
     Returns:
         Path | None: Path for the output file, or None if no transcoding is needed.
     """
-    if not input_file_path.exists():
-        print(f"Skipping missing input path: {input_file_path}")
+    input_path_str = os.fspath(input_file_path)
+
+    def stat_candidate(counter: int) -> os.stat_result | None:
+        candidate_path_str = _derive_mp4_output(input_path_str, counter)
+        if existing is not None and os.path.basename(candidate_path_str) not in existing:
+            return None
+        return _try_stat(candidate_path_str)
+
+    if not (input_file_path.exists() if existing is None else input_file_path.name in existing):
+        logger.info("Skipping missing input path: %s", input_file_path)
         return None
-    if is_h264_encoded(input_file_path):
-        print(f"MP4 file is already encoded in H264: {input_file_path}")
+    if is_h264_encoded_cached(input_file_path):
+        logger.info("MP4 file is already encoded in H264: %s", input_file_path)
         return None
-    for counter in range(1, max_retries + 1):
-        new_path = input_file_path.with_suffix(f".{counter}.mp4")
-        # case 1: candidate path does not exist
-        if not new_path.exists():
-            return new_path
-        # case 2: candidate path is an H264-encoded video file
-        elif new_path.is_file() and is_h264_encoded(new_path):
-            print(f"A subsequent file encoded in H264 already exists: {input_file_path} -> {new_path}")
+    # invariant: candidate `last_existing` exists with status `last_stat` (0 means none), and candidate `first_missing`
+    # does not exist or exceeds max_retries
+    last_existing, last_stat, first_missing = 0, None, 1
+    while first_missing <= max_retries and (candidate_stat := stat_candidate(first_missing)) is not None:
+        last_existing, last_stat, first_missing = first_missing, candidate_stat, first_missing * 2
+    first_missing = min(first_missing, max_retries + 1)
+    while first_missing - last_existing > 1:
+        middle = (last_existing + first_missing) // 2
+        if (candidate_stat := stat_candidate(middle)) is not None:
+            last_existing, last_stat = middle, candidate_stat
+        else:
+            first_missing = middle
+    if last_stat is not None:
+        last_path = Path(_derive_mp4_output(input_path_str, last_existing))
+        # case 1: last existing candidate is an H264-encoded video file
+        if stat.S_ISREG(last_stat.st_mode) and is_h264_encoded_cached(last_path, last_stat):
+            logger.info("A subsequent file encoded in H264 already exists: %s -> %s", input_file_path, last_path)
             return None
-        # case 3: candidate path exists but is not a file
-    return None
+        # case 2: last existing candidate is not a file, or not encoded in H264
+    if first_missing > max_retries:
+        return None
+    return Path(_derive_mp4_output(input_path_str, first_missing))
 
 
-def get_output_file_path_for_mkv(input_file_path: Path) -> Path | None:
+def get_output_file_path_for_mkv(input_file_path: Path, existing: set[str] | None = None) -> Path | None:
     """
     Generate HandBrake output file path for MKV files.
 
     Args:
         input_file_path (Path): Path to the input MKV file.
+        existing (set[str] | None, optional): Names of all entries in the directory of the input file. If given, it
+            replaces existence checks on the filesystem. Defaults to None.
 
     Returns:
         Path | None: Path for the output MP4 file, or None if no transcoding is needed.
     """
-    if not input_file_path.exists():
-        print(f"Skipping missing input path: {input_file_path}")
+    if not (input_file_path.exists() if existing is None else input_file_path.name in existing):
+        logger.info("Skipping missing input path: %s", input_file_path)
         return None
     mp4_file_path = input_file_path.with_suffix(".mp4")
-    if not mp4_file_path.exists():
+    if not (mp4_file_path.exists() if existing is None else mp4_file_path.name in existing):
         return mp4_file_path
-    return get_output_file_path_for_mp4(mp4_file_path)
+    return get_output_file_path_for_mp4(mp4_file_path, existing=existing)
+
 
+_OUTPUT_PATH_DISPATCH: dict[str, Callable[..., Path | None]] = {
+    ".mp4": get_output_file_path_for_mp4,
+    ".mkv": get_output_file_path_for_mkv,
+}
 
-def get_output_file_path(input_file_path: Path) -> Path | None:
+
+def get_output_file_path(input_file_path: Path, existing: set[str] | None = None) -> Path | None:
     """
     Generate HandBrake output file path for MKV and MP4 files.
 
     Args:
         input_file_path (Path): Path to the input video file.
+        existing (set[str] | None, optional): Names of all entries in the directory of the input file. If given, it
+            replaces existence checks on the filesystem. Defaults to None.
 
     Returns:
         Path | None: Path for the output file, or None if no transcoding is needed.
@@ -156,16 +914,90 @@ def get_output_file_path(input_file_path: Path) -> Path | None:
     Raises:
         ValueError: If the input file type is not supported (.mp4 or .mkv).
     """
-    match input_file_path.suffix.lower():
-        case ".mp4":
-            return get_output_file_path_for_mp4(input_file_path)
-        case ".mkv":
-            return get_output_file_path_for_mkv(input_file_path)
-        case _:
-            raise ValueError(f"Unsupported file type: {input_file_path}")
+    suffix = os.path.splitext(input_file_path.name)[1]
+    # only mixed-case suffixes need the second lookup
+    get_output_file_path_for_suffix = _OUTPUT_PATH_DISPATCH.get(suffix) or _OUTPUT_PATH_DISPATCH.get(suffix.lower())
+    if get_output_file_path_for_suffix is None:
+        raise ValueError(f"Unsupported file type: {input_file_path}")
+    return get_output_file_path_for_suffix(input_file_path, existing=existing)
+
+
+def _walk_files_with_dir_names(dir_path: Path, name_filter: Callable[[str], bool]) -> Iterator[Tuple[Path, set[str]]]:
+    """
+    Recursively yield all files in a directory whose names pass a filter in a single pass, without following directory
+    symlinks, together with the names of all entries in the directory of each file.
+
+    Args:
+        dir_path (Path): Directory to search for files.
+        name_filter (Callable[[str], bool]): Predicate on file names.
+
+    Yields:
+        Tuple[Path, set[str]]: Paths to matching files, and entry names of their directories. Files in the same
+            directory share the same set.
+    """
+    stack = [os.fspath(dir_path)]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entry_iterator:
+                entries = list(entry_iterator)
+        except OSError as e:
+            logger.warning("Could not scan directory due to %s: %s", type(e).__name__, e)
+            continue
+        names = {entry.name for entry in entries}
+        for entry in entries:
+            # DirEntry caches the file type from readdir, so these checks do not cost a syscall
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif name_filter(entry.name) and entry.is_file():
+                yield Path(entry.path), names
+
+
+def _walk_files(dir_path: Path, name_filter: Callable[[str], bool]) -> Iterator[Path]:
+    """
+    Recursively yield all files in a directory whose names pass a filter in a single pass, without following directory symlinks.
 
+    Args:
+        dir_path (Path): Directory to search for files.
+        name_filter (Callable[[str], bool]): Predicate on file names.
+
+    Yields:
+        Path: Paths to matching files.
+    """
+    for file_path, _ in _walk_files_with_dir_names(dir_path, name_filter):
+        yield file_path
+
+
+def _walk_videos(dir_path: Path) -> Iterator[Path]:
+    """
+    Recursively yield all MKV and MP4 files in a directory in a single pass, without following directory symlinks.
+
+    Args:
+        dir_path (Path): Directory to search for video files.
 
-def yield_transcode_tasks(dir_path: Path) -> Iterator[Tuple[Path, Path]]:
+    Yields:
+        Path: Paths to video files.
+    """
+    return _walk_files(dir_path, _is_video_file_name)
+
+
+def _get_output_file_path_when_stable(input_file_path: Path, existing: set[str] | None = None) -> Path | None:
+    """
+    Wait for a file to stabilize, then generate its HandBrake output file path.
+
+    Args:
+        input_file_path (Path): Path to the input video file.
+        existing (set[str] | None, optional): Names of all entries in the directory of the input file, passed on to
+            `get_output_file_path`. Defaults to None.
+
+    Returns:
+        Path | None: Path for the output file, or None if the file did not stabilize or no transcoding is needed.
+    """
+    if not wait_until_file_stable(input_file_path):
+        return None
+    return get_output_file_path(input_file_path, existing=existing)
+
+
+def yield_transcode_tasks(dir_path: Path) -> Generator[Tuple[Path, Path], None, None]:
     """
     Yield all video file paths in a directory that need transcoding.
 
@@ -176,10 +1008,53 @@ def yield_transcode_tasks(dir_path: Path) -> Iterator[Tuple[Path, Path]]:
         Tuple[Path, Path]: Pairs of (input_path, output_path) for files needing transcoding.
     """
     prepare_input_dir(dir_path)
-    for suffix in (".mkv", ".mp4"):
-        for input_file_path in dir_path.glob(f"**/*{suffix}"):
-            if wait_until_file_stable(input_file_path) and (output_file_path := get_output_file_path(input_file_path)):
+    # the entry names read by the walk double as the existence checks on output candidates, so that these do not
+    # cost a stat each. Only the chosen output is checked again before it is yielded.
+    input_files = _walk_files_with_dir_names(dir_path, _is_video_file_name)
+    # stability checks take seconds per file but mostly sleep, so the files of a batch are waited on concurrently.
+    # threads are only started once files are submitted.
+    executor = ThreadPoolExecutor(max_workers=MEDIAINFO_BATCHER.batch_size, thread_name_prefix="scan")
+    try:
+        while batch := list(islice(input_files, MEDIAINFO_BATCHER.batch_size)):
+            # MP4 files are probed both as inputs and as existing outputs, and probing them before the stability checks
+            # is harmless because cache entries are invalidated if the file changes afterwards
+            prefetch_h264_cache(file_path for file_path, _ in batch if file_path.name[-4:].lower() == ".mp4")
+            input_file_paths, existing_sets = zip(*batch)
+            # results are yielded in walk order as they become available
+            for input_file_path, output_file_path in zip(input_file_paths, executor.map(_get_output_file_path_when_stable, input_file_paths, existing_sets)):
+                # the name set was listed before the stability wait, and before earlier tasks were transcoded while
+                # this generator was suspended, so a chosen output that has appeared since is resolved again
+                if output_file_path is not None and _try_stat(output_file_path) is not None:
+                    output_file_path = get_output_file_path(input_file_path)
+                if output_file_path is not None:
+                    yield input_file_path, output_file_path
+    finally:
+        # if the consumer stops early, checks that have not started yet are cancelled instead of run to completion
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def yield_transcode_tasks_for_files(file_paths: Iterable[Path]) -> Iterator[Tuple[Path, Path]]:
+    """
+    Yield transcode tasks for video files reported by `InotifyWatcher`.
+
+    Some writers close a file several times before it is complete, e.g. Samba or torrent clients, so a close event only
+    triggers the stability check instead of replacing it. Files are waited on concurrently.
+
+    Args:
+        file_paths (Iterable[Path]): Paths to video files.
+
+    Yields:
+        Tuple[Path, Path]: Pairs of (input_path, output_path) for files needing transcoding.
+    """
+    if not (input_file_paths := list(file_paths)):
+        return
+    executor = ThreadPoolExecutor(max_workers=min(len(input_file_paths), MEDIAINFO_BATCHER.batch_size), thread_name_prefix="scan")
+    try:
+        for input_file_path, output_file_path in zip(input_file_paths, executor.map(_get_output_file_path_when_stable, input_file_paths)):
+            if output_file_path is not None:
                 yield input_file_path, output_file_path
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 def get_video_duration_milliseconds(file_path: Path) -> int | None:
@@ -193,16 +1068,185 @@ def get_video_duration_milliseconds(file_path: Path) -> int | None:
         int | None: Duration of the video in milliseconds, or None if no video track is found.
     """
     try:
-        for track in MediaInfo.parse(file_path).tracks:
-            if track.track_type == "Video":
-                return int(float(track.duration))  # track.duration might look like '3614866.000000'
+        if (track_info := _probe_video_track(file_path)) is not None:
+            return track_info.duration_ms
     except Exception as e:
-        print(f"Could not get duration of {file_path} due to {type(e).__name__}: {e}")
+        logger.warning("Could not get duration of %s due to %s: %s", file_path, type(e).__name__, e)
         return None
-    print(f"Skipping duration check because no video track was found in {file_path}")
+    logger.info("Skipping duration check because no video track was found in %s", file_path)
     return None
 
 
+def _terminate_process_group(process: subprocess.Popen, grace_seconds: float = 10) -> None:
+    """
+    Send SIGTERM to the process group of a session leader, followed by SIGKILL if it is still running after a grace period.
+
+    Args:
+        process (subprocess.Popen): Process started with `start_new_session=True`.
+        grace_seconds (float, optional): Time to wait between SIGTERM and SIGKILL in seconds. Defaults to 10.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=grace_seconds)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def run_handbrake(command: list[str], timeout_seconds: float, stall_timeout_seconds: float = 300) -> None:
+    """
+    Run HandBrake in a new session and stream its output. The whole process group is terminated if HandBrake runs for
+    longer than `timeout_seconds`, or does not report encoding progress for `stall_timeout_seconds`.
+
+    Args:
+        command (list[str]): HandBrake command line.
+        timeout_seconds (float): Maximum run time in seconds.
+        stall_timeout_seconds (float, optional): Maximum time between progress reports in seconds. Defaults to 300.
+
+    Raises:
+        subprocess.TimeoutExpired: If HandBrake timed out.
+        TranscodeStalled: If HandBrake stopped reporting progress.
+        subprocess.CalledProcessError: If HandBrake exited with a non-zero code.
+    """
+    # on Linux, Popen spawns with vfork as long as no preexec_fn, user or group change is requested, so a large
+    # parent process does not pay for copying its page tables.
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1, text=True, errors="replace",
+        start_new_session=True,
+    )
+    start_time = last_progress_time = time.monotonic()
+    finished = threading.Event()
+    failures: list[Exception] = []
+
+    def watchdog() -> None:
+        while not finished.wait(1):
+            current_time = time.monotonic()
+            if current_time - start_time >= timeout_seconds:
+                failures.append(subprocess.TimeoutExpired(command, timeout_seconds))
+            elif current_time - last_progress_time >= stall_timeout_seconds:
+                failures.append(TranscodeStalled(f"No progress reported for {stall_timeout_seconds} seconds: {command}"))
+            else:
+                continue
+            _terminate_process_group(process)
+            return
+
+    watchdog_thread = threading.Thread(target=watchdog, name=f"handbrake-watchdog-{process.pid}", daemon=True)
+    watchdog_thread.start()
+    last_percent = -1
+    try:
+        assert process.stdout is not None
+        # progress is terminated by carriage returns, which universal newlines mode treats as line breaks
+        for line in process.stdout:
+            if match := HANDBRAKE_PROGRESS_PATTERN.search(line):
+                last_progress_time = time.monotonic()
+                if (percent := int(match.group(1))) != last_percent:
+                    last_percent = percent
+                    logger.info("%s", line.strip())
+            elif line := line.rstrip():
+                logger.info("%s", line)
+    finally:
+        finished.set()
+        watchdog_thread.join()
+        if process.poll() is None:
+            _terminate_process_group(process)
+        returncode = process.wait()
+    if failures:
+        raise failures[0]
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+
+
+def get_video_durations_milliseconds(*file_paths: Path) -> list[int | None]:
+    """
+    Get the durations of several video files in milliseconds, using a single batched MediaInfo probe where possible.
+
+    Args:
+        *file_paths (Path): Paths to the video files.
+
+    Returns:
+        list[int | None]: Duration of each video in milliseconds, or None if no video track is found.
+    """
+    probed = MEDIAINFO_BATCHER.probe(file_paths)
+    durations = []
+    for file_path in file_paths:
+        if file_path not in probed:  # the batched probe is unavailable or failed
+            durations.append(get_video_duration_milliseconds(file_path))
+        elif (track_info := probed[file_path]) is None or track_info.duration_ms is None:
+            logger.info("Skipping duration check because no video track was found in %s", file_path)
+            durations.append(None)
+        else:
+            durations.append(track_info.duration_ms)
+    return durations
+
+
+def _commit_output_file(temp_file_path: Path, output_file_path: Path) -> None:
+    """
+    Durably move a finished temp output file to its final path, without overwriting an existing file.
+
+    The file is flushed to disk before it is linked to the final path, and the directory is flushed after the temp path
+    is removed, so that a crash cannot leave a truncated output file behind. On filesystems without hard links, it falls
+    back to checking for an existing file before renaming.
+
+    Args:
+        temp_file_path (Path): Path to the finished temp output file.
+        output_file_path (Path): Final path of the output file.
+
+    Raises:
+        FileExistsError: If the output path already exists.
+    """
+    fd = os.open(temp_file_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    dir_fd = os.open(output_file_path.parent, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    try:
+        try:
+            os.link(temp_file_path, output_file_path)
+            os.unlink(temp_file_path)
+        except FileExistsError:
+            raise
+        except OSError as e:
+            if e.errno not in (errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+            if output_file_path.exists():
+                raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), str(output_file_path)) from e
+            os.rename(temp_file_path, output_file_path)
+        try:
+            os.fsync(dir_fd)
+        except OSError as e:
+            # some network and FUSE filesystems cannot sync directories, and the output is already in place
+            if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+    finally:
+        os.close(dir_fd)
+
+
+@lru_cache(maxsize=None)
+def get_handbrake_prefix(config_file_path: Path = HANDBRAKE_CONFIG) -> Tuple[str, ...]:
+    """
+    Build the leading HandBrake CLI arguments for a preset file.
+
+    The preset file is parsed and validated once per path, and the preset is selected by name, so that a malformed
+    preset fails before any encode starts, and HandBrake does not fall back to its default preset.
+
+    Args:
+        config_file_path (Path, optional): Path to HandBrake config file. Defaults to `HANDBRAKE_CONFIG`.
+
+    Returns:
+        Tuple[str, ...]: HandBrake executable, followed by preset import and selection arguments.
+
+    Raises:
+        ValueError: If the config file does not contain exactly one preset.
+    """
+    with open(config_file_path, "rb") as f:
+        preset_list = json.load(f).get("PresetList", [])
+    if len(preset_list) != 1 or not preset_list[0].get("PresetName"):
+        raise ValueError(f"Expected exactly one named preset: {config_file_path}")
+    return _HANDBRAKE_BIN, "--preset-import-file", str(config_file_path), "--preset", preset_list[0]["PresetName"]
+
+
 def transcode_video_file(input_file_path: Path, output_file_path: Path, config_file_path: Path = HANDBRAKE_CONFIG) -> None:
     """
     Transcode a video file using HandBrake CLI.
@@ -213,59 +1257,195 @@ def transcode_video_file(input_file_path: Path, output_file_path: Path, config_f
         input_file_path (Path): Path to the input video file.
         output_file_path (Path): Path to the output video file.
         config_file_path (Path, optional): Path to HandBrake config file. Defaults to `HANDBRAKE_CONFIG`.
+
+    Raises:
+        subprocess.TimeoutExpired: If HandBrake timed out.
+        TranscodeStalled: If HandBrake stopped reporting progress.
     """
     temp_output_file_path = output_file_path.parent / (output_file_path.name + ".tmp")
     if temp_output_file_path.exists():
-        print(f"Skipping transcoding because the temp output path already exists: {temp_output_file_path}")
+        logger.info("Skipping transcoding because the temp output path already exists: %s", temp_output_file_path)
         return
     command = [
-        "HandBrakeCLI",
-        "--preset-import-file", str(config_file_path),
+        *get_handbrake_prefix(config_file_path),
         "-i", str(prepare_input_file(input_file_path)),
         "-o", str(prepare_output_file(temp_output_file_path)),
     ]
-    print(f"Starting subprocess: {command}")
+    logger.info("Starting subprocess: %s", command)
     # HandBrake may fail due to CUDA issues, in which case the container needs to be restarted
     try:
         timeout_seconds = (get_video_duration_milliseconds(input_file_path) or 7_200_000)/ 1000  # default to 2 hours timeout
-        subprocess.run(command, check=True, timeout=timeout_seconds)
-        if not output_file_path.exists():
-            temp_output_file_path.rename(output_file_path)
-        print(f"HandBrake finished successfully: {input_file_path} -> {output_file_path}")
-    except subprocess.TimeoutExpired:
-        print(f"HandBrake timed out after 1 hour processing {input_file_path}")
+        with HANDBRAKE_SLOTS:
+            run_handbrake(command, timeout_seconds)
+        try:
+            _commit_output_file(temp_output_file_path, output_file_path)
+        except FileExistsError:
+            logger.warning("Discarding transcoded file because the output path already exists: %s", output_file_path)
+            temp_output_file_path.unlink(missing_ok=True)
+            return
+        logger.info("HandBrake finished successfully: %s -> %s", input_file_path, output_file_path)
+        # the headers of the output are still in the page cache, so recording its codec now spares later scans a probe
+        if (codec := _sniff_video_codec(output_file_path)) is not None and (output_stat := _try_stat(output_file_path)) is not None:
+            _store_cached_codec(output_file_path, output_stat, codec)
+    except subprocess.TimeoutExpired as e:
+        logger.error("HandBrake timed out after %s seconds processing %s", e.timeout, input_file_path)
         temp_output_file_path.unlink(missing_ok=True)
         raise
+    except TranscodeStalled:
+        logger.error("HandBrake stalled processing %s", input_file_path)
+        temp_output_file_path.unlink(missing_ok=True)
+        raise
+
+
+def run_janitor(*dir_paths: Path, sweep_interval_seconds: float = 600, max_temp_age_seconds: float = 3600) -> None:
+    """
+    Delete files queued in `_JANITOR_QUEUE` forever, off the transcoding critical path. Between deletions, it also
+    periodically sweeps the monitored directories for temp output files that have not been written to for a while,
+    which are left behind when the daemon is killed mid-transcode and would otherwise block their input file for good.
+
+    Args:
+        *dir_paths (Path): One or more directory paths to sweep.
+        sweep_interval_seconds (float, optional): Time between sweeps in seconds. Defaults to 600.
+        max_temp_age_seconds (float, optional): Time since the last modification after which temp output files are deleted. Defaults to 3600.
+    """
+    next_sweep_time = time.monotonic()
+    while True:
+        try:
+            file_path = _JANITOR_QUEUE.get(timeout=max(next_sweep_time - time.monotonic(), 0))
+            logger.info("Deleting %s", file_path)
+            file_path.unlink(missing_ok=True)
+        except queue.Empty:
+            for dir_path in dir_paths:
+                for temp_file_path in _walk_files(dir_path, lambda name: name.endswith(".mp4.tmp")):
+                    try:
+                        if time.time() - temp_file_path.stat().st_mtime > max_temp_age_seconds:
+                            logger.info("Deleting stale temp output file: %s", temp_file_path)
+                            temp_file_path.unlink(missing_ok=True)
+                    except OSError as e:
+                        logger.warning("Could not delete %s due to %s: %s", temp_file_path, type(e).__name__, e)
+            next_sweep_time = time.monotonic() + sweep_interval_seconds
+        except OSError as e:
+            logger.warning("Could not delete %s due to %s: %s", file_path, type(e).__name__, e)
+
+
+def verify_transcode_output(input_file_path: Path, output_file_path: Path) -> None:
+    """
+    Verify that input and output video durations match. On mismatch, the output file is queued for deletion by `run_janitor`.
 
+    Args:
+        input_file_path (Path): Path to the input video file.
+        output_file_path (Path): Path to the transcoded output video file.
+    """
+    input_duration_ms, output_duration_ms = get_video_durations_milliseconds(input_file_path, output_file_path)
+    if input_duration_ms is None or output_duration_ms is None:
+        return
+    if abs(input_duration_ms - output_duration_ms) > DURATION_TOLERANCE_MS:
+        logger.error("Duration mismatch: %s (%sms) -> %s (%sms)", input_file_path, input_duration_ms, output_file_path, output_duration_ms)
+        _JANITOR_QUEUE.put(output_file_path)
+
+
+def transcode_worker(task_queue: queue.Queue[Tuple[Path, Path]], errors: list[BaseException], retry: threading.Event) -> None:
+    """
+    Consume transcode tasks from a queue forever. Exceptions are collected rather than raised, and once any worker
+    has failed, the remaining tasks are drained without being processed.
+
+    The GPU health check is repeated before each transcode, so that a failed GPU is detected without waiting for the
+    next directory scan.
 
-def monitor_and_transcode(*dir_paths: Path, check_interval_seconds: float = 60) -> None:
+    Args:
+        task_queue (queue.Queue[Tuple[Path, Path]]): Queue of (input_path, output_path) pairs.
+        errors (list[BaseException]): Shared list to which exceptions are appended.
+        retry (threading.Event): Set if HandBrake stalled, so that the file is retried in a full scan. Files on which
+            HandBrake has stalled `MAX_STALL_ATTEMPTS` times are skipped until they change.
+    """
+    while True:
+        input_file_path, output_file_path = task_queue.get()
+        try:
+            if errors:
+                continue
+            if load_stall_attempts(input_file_path) >= MAX_STALL_ATTEMPTS:
+                logger.info("Skipping file on which HandBrake has stalled %s times: %s", MAX_STALL_ATTEMPTS, input_file_path)
+                continue
+            if not is_gpu_healthy():
+                logger.error("GPU health check failed. Restarting...")
+                errors.append(SystemExit(2))  # ENOENT, same as the check in `monitor_and_transcode`
+                continue
+            transcode_video_file(input_file_path, output_file_path)
+            verify_transcode_output(input_file_path, output_file_path)
+        except TranscodeStalled:
+            if (attempts := record_stall(input_file_path)) >= MAX_STALL_ATTEMPTS:
+                logger.error("Giving up on %s after HandBrake stalled %s times", input_file_path, attempts)
+            else:
+                retry.set()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            task_queue.task_done()
+
+
+def monitor_and_transcode(*dir_paths: Path, check_interval_seconds: float = 60, num_workers: int = TRANSCODE_WORKERS, full_scan_interval_seconds: float = 3600) -> None:
     """
     Monitor directories and transcode new video files as they appear. After transcoding, it verifies that input and output video durations match.
 
+    Directory scans run on the calling thread and feed a bounded queue, so that discovery of the next file overlaps
+    with the transcoding of the current one. Transcoding runs on `num_workers` threads, while the number of concurrent
+    HandBrake processes is capped by `HANDBRAKE_SLOTS`.
+
+    On Linux, directories are walked on the first scan, and then only every `full_scan_interval_seconds`. In between,
+    only files that inotify reports as closed after writing or moved into place are checked for stability. The full
+    scans pick up files that raise no inotify events, e.g. those written by other hosts to a network filesystem, and
+    retry inputs whose outputs have been discarded. Elsewhere, directories are re-scanned every `check_interval_seconds`.
+
     Args:
         *dir_paths (Path): One or more directory paths to monitor.
-        check_interval_seconds (float, optional): Time between directory scans in seconds. Defaults to 60.
+        check_interval_seconds (float, optional): Time between directory scans, or between GPU health checks while waiting for inotify events, in seconds. Defaults to 60.
+        num_workers (int, optional): Number of transcode worker threads. Defaults to `TRANSCODE_WORKERS`.
+        full_scan_interval_seconds (float, optional): Time between full scans while using inotify, in seconds. Defaults to 3600.
     """
+    get_handbrake_prefix()  # fail fast on a malformed preset
+    task_queue: queue.Queue[Tuple[Path, Path]] = queue.Queue(maxsize=2 * num_workers)
+    errors: list[BaseException] = []
+    retry = threading.Event()
+    for i in range(num_workers):
+        threading.Thread(target=transcode_worker, args=(task_queue, errors, retry), name=f"transcode-worker-{i}", daemon=True).start()
+    threading.Thread(target=run_janitor, args=dir_paths, name="janitor", daemon=True).start()
+    # start watching before the first scan, so that no file written in between is missed
+    watcher = None
+    if sys.platform == "linux":
+        try:
+            watcher = InotifyWatcher(*dir_paths)
+        except OSError as e:
+            logger.warning("Falling back to polling because inotify is unavailable due to %s: %s", type(e).__name__, e)
+    rescan = True
+    last_full_scan_time = 0.0
     while True:
         if not is_gpu_healthy():
-            print("GPU health check failed. Restarting...")
+            logger.error("GPU health check failed. Restarting...")
             sys.exit(2)  # ENOENT
-        for input_file_path, output_file_path in chain.from_iterable(map(yield_transcode_tasks, dir_paths)):
-            transcode_video_file(input_file_path, output_file_path)
-            input_duration_ms = get_video_duration_milliseconds(input_file_path)
-            if input_duration_ms is None:
-                print(f"Skipping duration check because no video track was found in {input_file_path}")
-                continue
-            output_duration_ms = get_video_duration_milliseconds(output_file_path)
-            if output_duration_ms is None:
-                print(f"Skipping duration check because no video track was found in {output_file_path}")
-                continue
-            if abs(input_duration_ms - output_duration_ms) > 500:  # at 30 fps, 500ms is 15 frames
-                print(f"Duration mismatch: {input_file_path} ({input_duration_ms}ms) -> {output_file_path} ({output_duration_ms}ms)")
-                output_file_path.unlink(missing_ok=True)
-        print(f"Sleeping for {check_interval_seconds} seconds...")
-        time.sleep(check_interval_seconds)
+        if watcher is None or rescan or retry.is_set() or time.monotonic() - last_full_scan_time >= full_scan_interval_seconds:
+            retry.clear()
+            last_full_scan_time = time.monotonic()
+            prune_h264_cache()
+            tasks: Iterator[Tuple[Path, Path]] = chain.from_iterable(map(yield_transcode_tasks, dir_paths))
+        else:
+            tasks = yield_transcode_tasks_for_files(watcher.get_closed_file_paths(timeout_seconds=check_interval_seconds))
+        for task in tasks:
+            if errors:
+                break
+            task_queue.put(task)
+        # wait for the workers to finish, so that the next scan does not pick up files that are still being transcoded
+        task_queue.join()
+        if errors:
+            raise errors[0]
+        if watcher is None:
+            logger.info("Sleeping for %s seconds...", check_interval_seconds)
+            time.sleep(check_interval_seconds)
+        else:
+            # fall back to a full scan if inotify events have been lost
+            rescan = watcher.overflowed.is_set()
+            watcher.overflowed.clear()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(threadName)s %(message)s")
     monitor_and_transcode(Path(os.environ.get("MONITOR_DIR", PROJECT_ROOT / "assets")))
@@ -1,3 +1,6 @@
+import sys
+import threading
+import time
 from unittest.mock import Mock
 
 import pytest
@@ -5,17 +8,45 @@ import pytest
 import handbrake_daemon.__main__ as testee
 
 
-@pytest.mark.parametrize("format,expected", [("AVC", True), ("HEVC", False)])
-def test_is_h264_encoded(mocker, tmp_path, format, expected):
-    mocker.patch.object(testee, "prepare_input_file", lambda x: x)
-    mocker.patch.object(testee.MediaInfo, "parse", return_value=Mock(tracks=[Mock(track_type="Video", format=format)]))
-    assert testee.is_h264_encoded(tmp_path / "test.mp4", file_stable_flag=True) is expected
+@pytest.fixture(autouse=True)
+def state_db(mocker):
+    mocker.patch.object(testee, "_STATE_DB", testee._open_state_db(":memory:"))
 
 
-def test_is_h264_encoded_no_video_track(mocker, tmp_path):
+@pytest.fixture
+def fake_tracks(mocker):
     mocker.patch.object(testee, "prepare_input_file", lambda x: x)
-    mocker.patch.object(testee.MediaInfo, "parse", return_value=Mock(tracks=[]))
-    assert testee.is_h264_encoded(tmp_path / "test.mp4", file_stable_flag=True) is None
+    return mocker.patch.object(testee, "_parse_tracks", return_value=None)
+
+
+@pytest.mark.parametrize("format,expected", [("AVC", True), ("HEVC", False)])
+def test_is_h264_encoded(fake_tracks, tmp_path, format, expected):
+    (file_path := tmp_path / "test.mp4").touch()
+    fake_tracks.return_value = testee.VideoTrackInfo(format, None)
+    assert testee.is_h264_encoded(file_path) is expected
+
+
+def test_is_h264_encoded_no_video_track(fake_tracks, tmp_path):
+    (file_path := tmp_path / "test.mp4").touch()
+    assert testee.is_h264_encoded(file_path) is None
+
+
+@pytest.mark.parametrize("header,expected", [
+    (b"\x00\x00\x00\x95stsd\x00\x00\x00\x00\x00\x00\x00\x01\x00\x00\x00\x85avc1", "AVC"),
+    (b"\x00\x00\x00\x95stsd\x00\x00\x00\x00\x00\x00\x00\x01\x00\x00\x00\x85hvc1", "HEVC"),
+    (b"\x1aE\xdf\xa3\x86\x8fV_MPEGH/ISO/HEVC", "HEVC"),
+    (b"\x00\x00\x00\x08mdat", None),
+])
+def test_sniff_video_codec(tmp_path, header, expected):
+    file_path = tmp_path / "test.mp4"
+    file_path.write_bytes(b"\x00" * 100 + header + b"\x00" * 100)
+    assert testee._sniff_video_codec(file_path) == expected
+
+
+def test_is_h264_encoded_sniffed(mocker, fake_tracks, tmp_path):
+    mocker.patch.object(testee, "_sniff_video_codec", return_value="AVC")
+    assert testee.is_h264_encoded(tmp_path / "test.mkv") is True
+    fake_tracks.assert_not_called()
 
 
 def test_get_output_file_path_for_mp4_file_not_exists(tmp_path):
@@ -24,24 +55,21 @@ def test_get_output_file_path_for_mp4_file_not_exists(tmp_path):
 
 
 def test_get_output_file_path_for_mp4_already_h264(mocker, tmp_path):
-    mocker.patch("pathlib.Path.exists", return_value=True)
-    mocker.patch.object(testee, "is_h264_encoded", return_value=True)
-    assert testee.get_output_file_path_for_mp4(tmp_path / "test.mp4") is None
+    mocker.patch.object(testee, "is_h264_encoded_cached", return_value=True)
+    assert testee.get_output_file_path_for_mp4(tmp_path / "test.mp4", existing={"test.mp4"}) is None
 
 
 def test_get_output_file_path_for_mp4_needs_encoding(mocker, tmp_path):
-    mocker.patch("pathlib.Path.exists", side_effect=[True, False])
-    mocker.patch.object(testee, "is_h264_encoded", return_value=False)
-    assert testee.get_output_file_path_for_mp4(tmp_path / "test.mp4") == tmp_path / "test.1.mp4"
+    mocker.patch.object(testee, "is_h264_encoded_cached", return_value=False)
+    assert testee.get_output_file_path_for_mp4(tmp_path / "test.mp4", existing={"test.mp4"}) == tmp_path / "test.1.mp4"
 
 
 def test_get_output_file_path_for_mkv_file_not_exists(tmp_path):
     assert testee.get_output_file_path_for_mkv(tmp_path / "test.mkv") is None
 
 
-def test_get_output_file_path_for_mkv_mp4_not_exists(mocker, tmp_path):
-    mocker.patch("pathlib.Path.exists", side_effect=[True, False])
-    assert testee.get_output_file_path_for_mkv(tmp_path / "test.mkv") == tmp_path / "test.mp4"
+def test_get_output_file_path_for_mkv_mp4_not_exists(tmp_path):
+    assert testee.get_output_file_path_for_mkv(tmp_path / "test.mkv", existing={"test.mkv"}) == tmp_path / "test.mp4"
 
 
 def test_get_output_file_path_unsupported_format(tmp_path):
@@ -54,20 +82,367 @@ def test_yield_transcode_tasks(mocker, tmp_path):
     mp4_file = tmp_path / "test.mp4"
     mkv_file.touch()
     mp4_file.touch()
-    mocker.patch.object(testee, "get_output_file_path", lambda x: x.with_suffix(".output.mp4"))
+    (tmp_path / "test.txt").touch()
+    mocker.patch.object(testee, "wait_until_file_stable", return_value=True)
+    get_output_file_path = mocker.patch.object(testee, "get_output_file_path", side_effect=lambda x, existing: x.with_suffix(".output.mp4"))
     tasks = list(testee.yield_transcode_tasks(tmp_path))
     assert len(tasks) == 2
     assert all(isinstance(task, tuple) and len(task) == 2 for task in tasks)
     assert all(task[1].suffix == ".mp4" for task in tasks)
+    assert all(call.kwargs["existing"] == {"test.mkv", "test.mp4", "test.txt"} for call in get_output_file_path.call_args_list)
 
 
-def test_get_video_duration(mocker, tmp_path):
-    mocker.patch.object(testee, "prepare_input_file", lambda x: x)
-    mocker.patch.object(testee.MediaInfo, "parse", return_value=Mock(tracks=[Mock(track_type="Video", duration=5000)]))
-    assert testee.get_video_duration_milliseconds(tmp_path / "test.mp4") == 5000
+@pytest.mark.parametrize("path_str", ["test.mp4", "dir.d/test.MP4", "/dir/test.1.mp4"])
+def test_derive_mp4_output(path_str):
+    assert testee._derive_mp4_output(path_str, 2) == str(testee.Path(path_str).with_suffix(".2.mp4"))
 
 
-def test_get_video_duration_no_video_track(mocker, tmp_path):
-    mocker.patch.object(testee, "prepare_input_file", lambda x: x)
-    mocker.patch.object(testee.MediaInfo, "parse", return_value=Mock(tracks=[]))
-    assert testee.get_video_duration_milliseconds(tmp_path / "test.mp4") is None
+def test_yield_transcode_tasks_concurrent(mocker, tmp_path):
+    barrier = threading.Barrier(8, timeout=5)
+
+    def wait_until_file_stable(file_path):
+        barrier.wait()  # raises BrokenBarrierError unless all files are waited on at the same time
+        return True
+
+    for i in range(8):
+        (tmp_path / f"test{i}.mkv").touch()
+    mocker.patch.object(testee, "wait_until_file_stable", side_effect=wait_until_file_stable)
+    assert len(list(testee.yield_transcode_tasks(tmp_path))) == 8
+
+
+def test_yield_transcode_tasks_stale_names(mocker, tmp_path):
+    (tmp_path / "test.mkv").touch()
+
+    def wait_until_file_stable(file_path):
+        (tmp_path / "test.mp4").touch()  # published while the scan was waiting
+        return True
+
+    mocker.patch.object(testee, "wait_until_file_stable", side_effect=wait_until_file_stable)
+    mocker.patch.object(testee, "is_h264_encoded_cached", return_value=True)
+    assert list(testee.yield_transcode_tasks(tmp_path)) == []
+
+
+def test_yield_transcode_tasks_closed_early(mocker, tmp_path):
+    for i in range(8):
+        (tmp_path / f"test{i}.mkv").touch()
+    mocker.patch.object(testee, "MEDIAINFO_BATCHER", testee.MediaInfoBatcher(batch_size=8))
+    mocker.patch.object(testee, "wait_until_file_stable", return_value=True)
+    shutdown = mocker.spy(testee.ThreadPoolExecutor, "shutdown")
+    tasks = testee.yield_transcode_tasks(tmp_path)
+    next(tasks)
+    tasks.close()
+    shutdown.assert_called_once_with(mocker.ANY, wait=False, cancel_futures=True)
+
+
+def test_get_output_file_path_existing_names(mocker):
+    mocker.patch.object(testee, "is_h264_encoded_cached", return_value=False)
+    try_stat = mocker.patch.object(testee, "_try_stat", return_value=Mock(st_mode=0))
+    dir_path = testee.Path("/nonexistent")
+    assert testee.get_output_file_path(dir_path / "test.mkv", existing={"test.mkv"}) == dir_path / "test.mp4"
+    assert testee.get_output_file_path(dir_path / "test.mkv", existing=set()) is None
+    assert testee.get_output_file_path(dir_path / "test.mkv", existing={"test.mkv", "test.mp4", "test.1.mp4"}) == dir_path / "test.2.mp4"
+    try_stat.assert_called_once_with(str(dir_path / "test.1.mp4"))
+
+
+def test_walk_videos(tmp_path):
+    (tmp_path / "subdir").mkdir()
+    (tmp_path / "subdir" / "test.MKV").touch()
+    (tmp_path / "test.mp4").touch()
+    (tmp_path / "test.txt").touch()
+    assert sorted(testee._walk_videos(tmp_path)) == [tmp_path / "subdir" / "test.MKV", tmp_path / "test.mp4"]
+    assert sorted(testee._walk_files_with_dir_names(tmp_path, testee._is_video_file_name)) == [
+        (tmp_path / "subdir" / "test.MKV", {"test.MKV"}),
+        (tmp_path / "test.mp4", {"subdir", "test.mp4", "test.txt"}),
+    ]
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="inotify is only available on Linux")
+def test_inotify_watcher(tmp_path):
+    watcher = testee.InotifyWatcher(tmp_path)
+    try:
+        (tmp_path / "subdir").mkdir()
+        (tmp_path / "test.txt").write_bytes(b"data")
+        (tmp_path / "test.mkv").write_bytes(b"data")
+        assert watcher.get_closed_file_paths(timeout_seconds=5) == [tmp_path / "test.mkv"]
+        (tmp_path / "subdir" / "test.mp4").write_bytes(b"data")
+        assert watcher.get_closed_file_paths(timeout_seconds=5) == [tmp_path / "subdir" / "test.mp4"]
+    finally:
+        watcher.close()
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="inotify is only available on Linux")
+def test_inotify_watcher_open_file(tmp_path):
+    watcher = testee.InotifyWatcher(tmp_path)
+    try:
+        with open(tmp_path / "test.mkv", "wb") as f:
+            f.write(b"data")
+            f.flush()
+            assert watcher.get_closed_file_paths(timeout_seconds=1) == []
+        assert watcher.get_closed_file_paths(timeout_seconds=5) == [tmp_path / "test.mkv"]
+    finally:
+        watcher.close()
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="inotify is only available on Linux")
+def test_inotify_watcher_new_directory(tmp_path):
+    watcher = testee.InotifyWatcher(tmp_path)
+    wd = next(iter(watcher._watches))
+    try:
+        watcher._handle_event(wd, testee.IN_CREATE, "test.mkv")
+        (tmp_path / "subdir").mkdir()
+        (tmp_path / "subdir" / "test.mp4").touch()
+        watcher._handle_event(wd, testee.IN_CREATE | testee.IN_ISDIR, "subdir")
+        assert watcher.get_closed_file_paths(timeout_seconds=5) == [tmp_path / "subdir" / "test.mp4"]
+    finally:
+        watcher.close()
+
+
+def test_yield_transcode_tasks_for_files(mocker, tmp_path):
+    stable_file = tmp_path / "stable.mkv"
+    mocker.patch.object(testee, "wait_until_file_stable", side_effect=lambda file_path: file_path == stable_file)
+    mocker.patch.object(testee, "get_output_file_path", side_effect=lambda file_path, existing: file_path.with_suffix(".mp4"))
+    assert list(testee.yield_transcode_tasks_for_files([tmp_path / "partial.mkv", stable_file])) == [(stable_file, tmp_path / "stable.mp4")]
+    assert list(testee.yield_transcode_tasks_for_files([])) == []
+
+
+def test_get_video_duration(fake_tracks, tmp_path):
+    (file_path := tmp_path / "test.mp4").touch()
+    fake_tracks.return_value = testee.VideoTrackInfo("AVC", 5000)
+    assert testee.get_video_duration_milliseconds(file_path) == 5000
+
+
+def test_parse_tracks_cached(mocker, tmp_path):
+    (file_path := tmp_path / "test.mp4").write_bytes(b"\x00")
+    mocker.patch.object(testee, "_MEDIAINFO_LIBRARY", None)
+    parse = mocker.patch.object(testee.MediaInfo, "parse", return_value=Mock(tracks=[Mock(track_type="Video", format="AVC", duration=5000)]))
+    testee._parse_tracks.cache_clear()
+    assert testee.is_h264_encoded(file_path) is True
+    assert testee.get_video_duration_milliseconds(file_path) == 5000
+    parse.assert_called_once_with(str(file_path), parse_speed=0.0)
+    file_path.write_bytes(b"\x00\x00")
+    assert testee.get_video_duration_milliseconds(file_path) == 5000
+    assert parse.call_count == 2
+
+
+@pytest.mark.parametrize("value,expected", [("3614.866", 3614866), ("5", 5000), ("0.5", 500), ("1.23456", 1234)])
+def test_parse_seconds_as_milliseconds(value, expected):
+    assert testee._parse_seconds_as_milliseconds(value) == expected
+
+
+def test_get_video_durations_milliseconds(mocker, tmp_path):
+    mocker.patch.object(testee.MEDIAINFO_BATCHER, "probe", return_value={tmp_path / "a.mp4": testee.VideoTrackInfo("AVC", 5000)})
+    mocker.patch.object(testee, "get_video_duration_milliseconds", return_value=4000)
+    assert testee.get_video_durations_milliseconds(tmp_path / "a.mp4", tmp_path / "b.mp4") == [5000, 4000]
+
+
+def test_media_info_handle():
+    library = Mock()
+    library.MediaInfo_Open.return_value = 1
+    library.MediaInfo_Inform.return_value = "HEVC|3614866.000\nAVC|1000\n"
+    assert testee._MediaInfoHandle(library).probe(testee.Path("test.mkv")) == testee.VideoTrackInfo("HEVC", 3614866)
+    library.MediaInfo_Close.assert_called_once()
+    library.MediaInfo_Option.assert_any_call(library.MediaInfo_New.return_value, "ParseSpeed", "0.0")
+    library.MediaInfo_Inform.return_value = ""
+    handle = testee._MediaInfoHandle(library)
+    assert handle.probe(testee.Path("test.mkv")) is None
+    handle.close()
+    del handle
+    library.MediaInfo_Delete.assert_called_with(library.MediaInfo_New.return_value)
+    assert library.MediaInfo_Delete.call_count == 2
+
+
+def test_get_video_duration_no_video_track(fake_tracks, tmp_path):
+    (file_path := tmp_path / "test.mp4").touch()
+    assert testee.get_video_duration_milliseconds(file_path) is None
+
+
+def test_verify_transcode_output_duration_mismatch(mocker, tmp_path):
+    output_file = tmp_path / "test.1.mp4"
+    mocker.patch.object(testee, "get_video_durations_milliseconds", return_value=[5000, 4000])
+    janitor_queue = mocker.patch.object(testee, "_JANITOR_QUEUE", testee.queue.SimpleQueue())
+    testee.verify_transcode_output(tmp_path / "test.mp4", output_file)
+    assert janitor_queue.get_nowait() == output_file
+
+
+def test_is_h264_encoded_cached(mocker, tmp_path):
+    file_path = tmp_path / "test.mp4"
+    file_path.write_bytes(b"data")
+    get_video_codec = mocker.patch.object(testee, "get_video_codec", return_value="AVC")
+    assert testee.is_h264_encoded_cached(file_path) is True
+    assert testee.is_h264_encoded_cached(file_path) is True
+    assert get_video_codec.call_count == 1
+    file_path.write_bytes(b"modified")
+    assert testee.is_h264_encoded_cached(file_path) is True
+    assert get_video_codec.call_count == 2
+    file_path.unlink()
+    testee.prune_h264_cache()
+    assert testee._get_state_db().execute("SELECT COUNT(*) FROM probe").fetchone() == (0,)
+
+
+def test_media_info_batcher(mocker, tmp_path):
+    reports = [
+        {"media": {"@ref": str(tmp_path / "a.mp4"), "track": [{"@type": "General"}, {"@type": "Video", "Format": "AVC", "Duration": "5.000"}]}},
+        {"media": {"@ref": str(tmp_path / "b.mp4"), "track": [{"@type": "General"}]}},
+    ]
+    mocker.patch.object(testee.subprocess, "run", return_value=Mock(stdout=testee.json.dumps(reports)))
+    batcher = testee.MediaInfoBatcher(executable="mediainfo")
+    assert batcher.probe([tmp_path / "a.mp4", tmp_path / "b.mp4"]) == {
+        tmp_path / "a.mp4": testee.VideoTrackInfo("AVC", 5000),
+        tmp_path / "b.mp4": None,
+    }
+
+
+def test_run_handbrake(caplog):
+    script = "print('Encoding: task 1 of 1, 50.00 %', end='\\r'); print('Encoding: task 1 of 1, 50.10 %', end='\\r'); print('done')"
+    with caplog.at_level("INFO"):
+        testee.run_handbrake([sys.executable, "-c", script], timeout_seconds=10)
+    assert caplog.messages == ["Encoding: task 1 of 1, 50.00 %", "done"]
+
+
+def test_run_handbrake_failed():
+    with pytest.raises(testee.subprocess.CalledProcessError):
+        testee.run_handbrake([sys.executable, "-c", "raise SystemExit(3)"], timeout_seconds=10)
+
+
+def test_run_handbrake_stalled():
+    with pytest.raises(testee.TranscodeStalled):
+        testee.run_handbrake([sys.executable, "-c", "import time; time.sleep(30)"], timeout_seconds=10, stall_timeout_seconds=0.5)
+
+
+def test_fast_stat(tmp_path):
+    file_path = tmp_path / "test.mp4"
+    file_path.write_bytes(b"data")
+    stat_result = file_path.stat()
+    assert testee._fast_stat(file_path) == (stat_result.st_mode, stat_result.st_size, stat_result.st_mtime_ns)
+    with pytest.raises(FileNotFoundError):
+        testee._fast_stat(tmp_path / "missing.mp4")
+    assert testee._fast_stat(file_path, synced=True) == testee._fast_stat(file_path)
+
+
+def test_wait_until_file_stable_confirms_with_synced_stat(mocker, tmp_path):
+    cached_stat = testee.FileStat(0o100644, 100, 1)
+    synced_stats = iter([testee.FileStat(0o100644, 200, 2)] * 3)
+    fast_stat = mocker.patch.object(testee, "_fast_stat", side_effect=lambda file_path, synced=False: next(synced_stats) if synced else cached_stat)
+    assert testee.wait_until_file_stable(tmp_path / "test.mkv", check_interval_seconds=0, stability_duration_seconds=0) is True
+    assert [call.kwargs.get("synced", False) for call in fast_stat.call_args_list] == [False, False, True, True, True]
+
+
+@pytest.mark.parametrize("existing,max_retries,expected", [(0, 5, 1), (1, 5, 2), (3, 5, 4), (4, 5, 5), (5, 5, None), (12, 100, 13)])
+def test_get_output_file_path_for_mp4_counter(mocker, tmp_path, existing, max_retries, expected):
+    input_path = tmp_path / "test.mp4"
+    input_path.touch()
+    for counter in range(1, existing + 1):
+        input_path.with_suffix(f".{counter}.mp4").touch()
+    is_h264_encoded = mocker.patch.object(testee, "is_h264_encoded_cached", return_value=False)
+    output_path = testee.get_output_file_path_for_mp4(input_path, max_retries=max_retries)
+    assert output_path == (None if expected is None else input_path.with_suffix(f".{expected}.mp4"))
+    assert is_h264_encoded.call_count == (2 if existing else 1)
+
+
+@pytest.mark.parametrize("device_count,expected", [(0, False), (2, True)])
+def test_is_gpu_healthy_nvml(mocker, device_count, expected):
+    pynvml = mocker.patch.object(testee, "pynvml", create=True)
+    mocker.patch.object(testee, "NVML_AVAILABLE", True)
+    pynvml.nvmlDeviceGetCount.return_value = device_count
+    assert testee.is_gpu_healthy() is expected
+
+
+def test_commit_output_file(tmp_path):
+    temp_file = tmp_path / "test.mp4.tmp"
+    output_file = tmp_path / "test.mp4"
+    temp_file.write_bytes(b"first")
+    testee._commit_output_file(temp_file, output_file)
+    assert not temp_file.exists() and output_file.read_bytes() == b"first"
+    temp_file.write_bytes(b"second")
+    with pytest.raises(FileExistsError):
+        testee._commit_output_file(temp_file, output_file)
+    assert output_file.read_bytes() == b"first"
+
+
+def test_commit_output_file_directory_fsync_unsupported(mocker, tmp_path):
+    temp_file = tmp_path / "test.mp4.tmp"
+    output_file = tmp_path / "test.mp4"
+    temp_file.write_bytes(b"data")
+    real_fsync = testee.os.fsync
+    fsync_calls = []
+
+    def fsync(fd):
+        fsync_calls.append(fd)
+        if len(fsync_calls) == 2:  # the directory
+            raise OSError(testee.errno.EINVAL, "Invalid argument")
+        real_fsync(fd)
+
+    mocker.patch.object(testee.os, "fsync", side_effect=fsync)
+    testee._commit_output_file(temp_file, output_file)
+    assert output_file.read_bytes() == b"data"
+
+
+def test_get_handbrake_prefix(tmp_path):
+    prefix = testee.get_handbrake_prefix()
+    assert prefix[1:] == ("--preset-import-file", str(testee.HANDBRAKE_CONFIG), "--preset", "H.264 NVENC CQ27")
+    config_file = tmp_path / "empty.json"
+    config_file.write_text('{"PresetList": []}')
+    with pytest.raises(ValueError):
+        testee.get_handbrake_prefix(config_file)
+
+
+def test_transcode_video_file_caches_output_codec(mocker, tmp_path):
+    input_file = tmp_path / "test.mkv"
+    output_file = tmp_path / "test.mp4"
+    input_file.touch()
+    mocker.patch.object(testee, "get_video_duration_milliseconds", return_value=5000)
+    mocker.patch.object(testee, "run_handbrake", side_effect=lambda command, timeout_seconds: testee.Path(command[-1]).write_bytes(
+        b"\x00\x00\x00\x95stsd\x00\x00\x00\x00\x00\x00\x00\x01\x00\x00\x00\x85avc1"))
+    testee.transcode_video_file(input_file, output_file)
+    get_video_codec = mocker.patch.object(testee, "get_video_codec")
+    assert testee.is_h264_encoded_cached(output_file) is True
+    get_video_codec.assert_not_called()
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="inotify is only available on Linux")
+@pytest.mark.parametrize("full_scan_interval_seconds,expected", [(0, 3), (3600, 1)])
+def test_monitor_and_transcode_full_scans(mocker, tmp_path, full_scan_interval_seconds, expected):
+    watcher = mocker.patch.object(testee, "InotifyWatcher").return_value
+    watcher.get_closed_file_paths.return_value = []
+    watcher.overflowed.is_set.return_value = False
+    mocker.patch.object(testee, "is_gpu_healthy", side_effect=[True, True, True, False])
+    mocker.patch.object(testee, "transcode_worker")
+    mocker.patch.object(testee, "run_janitor")
+    mocker.patch.object(testee, "prune_h264_cache")
+    yield_transcode_tasks = mocker.patch.object(testee, "yield_transcode_tasks", return_value=iter([]))
+    with pytest.raises(SystemExit):
+        testee.monitor_and_transcode(tmp_path, check_interval_seconds=0, full_scan_interval_seconds=full_scan_interval_seconds)
+    assert yield_transcode_tasks.call_count == expected
+
+
+def test_transcode_worker_gives_up_after_stalls(mocker, tmp_path):
+    (input_file := tmp_path / "test.mkv").write_bytes(b"data")
+    mocker.patch.object(testee, "MAX_STALL_ATTEMPTS", 2)
+    mocker.patch.object(testee, "is_gpu_healthy", return_value=True)
+    transcode_video_file = mocker.patch.object(testee, "transcode_video_file", side_effect=testee.TranscodeStalled)
+    task_queue: testee.queue.Queue = testee.queue.Queue()
+    errors: list[BaseException] = []
+    retry = threading.Event()
+    threading.Thread(target=testee.transcode_worker, args=(task_queue, errors, retry), daemon=True).start()
+    for expected_retry in (True, False, False):
+        retry.clear()
+        task_queue.put((input_file, tmp_path / "test.mp4"))
+        task_queue.join()
+        assert retry.is_set() is expected_retry
+    assert transcode_video_file.call_count == 2
+    assert not errors
+    input_file.write_bytes(b"changed")
+    assert testee.load_stall_attempts(input_file) == 0
+
+
+@pytest.mark.parametrize("name_error,expected", [(False, True), (True, False)])
+def test_is_gpu_healthy_nvml_power_state_not_supported(mocker, name_error, expected):
+    pynvml = mocker.patch.object(testee, "pynvml", create=True)
+    mocker.patch.object(testee, "NVML_AVAILABLE", True)
+    pynvml.NVMLError = type("NVMLError", (Exception,), {})
+    pynvml.NVMLError_NotSupported = type("NVMLError_NotSupported", (pynvml.NVMLError,), {})
+    pynvml.nvmlDeviceGetCount.return_value = 1
+    pynvml.nvmlDeviceGetPowerState.side_effect = pynvml.NVMLError_NotSupported
+    if name_error:
+        pynvml.nvmlDeviceGetName.side_effect = pynvml.NVMLError
+    assert testee.is_gpu_healthy() is expected